@@ -1,4 +1,14 @@
+import io
+import json
+import mmap
+import os
+import struct
 from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing, contextmanager
+from itertools import islice
+from operator import add
 from sqlite3 import connect
 
 
@@ -8,35 +18,171 @@ class InvalidLayoutError(Exception):
         super().__init__(self.message)
 
 
+# struct format codes for integer widths that struct can unpack natively
+INT_FORMATS = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+# Version of the layout cache format, caches of other versions are ignored
+CACHE_VERSION = 3
+
+# Read buffer size for binary files that cannot be memory mapped
+BUFFER_SIZE = 1 << 20
+
+# Maximum number of rows of integer tables inserted with a single query of inlined values
+INLINE_ROWS = 1000
+
+# Number of rows fetched from the database at once when writing back
+FETCH_SIZE = 4096
+
+
+def compile_function(name, source, **namespace):
+    """Compiles the source of a generated function and returns the function."""
+    exec(source, namespace)
+    return namespace[name]
+
+
+def cached_int(value):
+    """Returns a non-negative integer read from the layout cache, raising ValueError for anything else."""
+    if type(value) is not int or value < 0:
+        raise ValueError(f'invalid integer in layout cache: {value!r}')
+    return value
+
+
+def cached_column(column):
+    """Returns a (name, type, length) column read from the layout cache, raising ValueError if it is invalid."""
+    name, type, length = column
+    if not isinstance(name, str) or type not in ('int', 'str'):
+        raise ValueError(f'invalid column in layout cache: {column!r}')
+    return (name, type, cached_int(length))
+
+
+# Parser of a worker process started by parse_file
+worker_parser = None
+
+
+def init_worker(parser):
+    """Receives the parser once per worker process, instead of once per decoded table."""
+    global worker_parser
+    worker_parser = parser
+
+
+def decode_table(binary_path, tablename):
+    """Decodes all rows of a table, run in a worker process by parse_file."""
+    with worker_parser.open_binary(binary_path) as read:
+        return list(worker_parser.iter_rows(read, worker_parser.data[tablename]))
+
+
 class BinaryParser:
-    def __init__(self, layout_path: str, byteorder='little', encoding='utf-8', file_offset=0):
+    def __init__(self, layout_path: str, byteorder='little', encoding='utf-8', file_offset=0, cache_layout=False):
+        if byteorder not in ('little', 'big'):
+            raise ValueError("byteorder must be either 'little' or 'big'")
         self.layout_path = layout_path
         self.byteorder = byteorder
         self.encoding = encoding
         self.sections = 0
         self.file_offset = file_offset
+        self.cache_layout = cache_layout
+        self.cache_path = layout_path + '.cache.json'
 
     def __enter__(self):
-        self.layout = open(self.layout_path)
-        self.parse_layout()
+        layout_mtime = os.stat(self.layout_path).st_mtime_ns
+        if not (self.cache_layout and self.load_layout_cache(layout_mtime)):
+            with open(self.layout_path) as f:
+                self.layout_text = f.read()
+            self.parse_layout()
+            if self.cache_layout:
+                self.save_layout_cache(layout_mtime)
         return self
 
     def __exit__(self, type, value, traceback):
-        self.layout.close()
+        pass
+
+    def __getstate__(self):
+        # Generated functions cannot be pickled, so worker processes compile the layout again
+        state = self.__dict__.copy()
+        state['data'] = self.uncompiled_layout()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.compile_layout()
+
+    def load_layout_cache(self, layout_mtime):
+        """Loads a previously parsed layout from the cache file.
+        Returns False if there is no valid cache for the current layout file."""
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+            if cache['version'] != CACHE_VERSION or cache['layout_mtime'] != layout_mtime:
+                return False
+            # Only the parsed layout itself is cached and it is checked value by value, everything
+            # derived from it, like strides, queries and generated code, is built again
+            self.data = {
+                tablename: {
+                    'count': cached_int(tablelayout['count']),
+                    'sections': [
+                        {
+                            'offset': cached_int(section['offset']),
+                            'data': [cached_column(column) for column in section['data']],
+                        }
+                        for section in tablelayout['sections']
+                    ],
+                }
+                for tablename, tablelayout in cache['data'].items()
+            }
+            self.sections = cached_int(cache['sections'])
+            self.compile_layout()
+        except (OSError, ValueError, KeyError, TypeError, AttributeError, OverflowError, struct.error):
+            return False
+        return True
+
+    def save_layout_cache(self, layout_mtime):
+        """Stores the parsed layout in the cache file, ignoring failures like a read-only directory."""
+        cache = {
+            'version': CACHE_VERSION,
+            'layout_mtime': layout_mtime,
+            'sections': self.sections,
+            'data': self.uncompiled_layout(),
+        }
+        try:
+            with open(self.cache_path, 'w') as f:
+                json.dump(cache, f)
+        except OSError:
+            pass
+
+    def uncompiled_layout(self):
+        """Returns the parsed layout without anything compile_layout derives from it."""
+        return {
+            tablename: {
+                'count': tablelayout['count'],
+                'sections': [
+                    {'offset': section['offset'], 'data': section['data']}
+                    for section in tablelayout['sections']
+                ],
+            }
+            for tablename, tablelayout in self.data.items()
+        }
 
     def parse_layout(self):
         """Parses the layout file and adds offsets and data lengths to a dictionary containing the data."""
         self.data = {}
+        lines = self.layout_text.splitlines()
         line = ''
         lineno = 0
+
+        def readline(lineno):
+            """Returns the line following line number lineno."""
+            if lineno >= len(lines):
+                raise InvalidLayoutError('unexpected end of file, the layout must end with endfile', lineno)
+            return lines[lineno].strip()
+
         while line != 'endfile':
             if line.startswith('begin'):
                 self.sections += 1
-                line = self.layout.readline().strip()
+                line = readline(lineno)
                 lineno += 1
                 try:
                     tablename, baseoffset, total, counts = line.split(' ')
-                except:
+                except ValueError:
                     raise InvalidLayoutError(
                         'table must have four arguments', lineno)
                 baseoffset = int(baseoffset, 0)  # Supports hexadecimal
@@ -54,7 +200,7 @@ class BinaryParser:
                     raise InvalidLayoutError(
                         f'Counts for table {tablename} must be equal for all sections of table {tablename}.', lineno)
 
-                line = self.layout.readline().strip()
+                line = readline(lineno)
                 section_lineno = lineno
                 lineno += 1
                 subtotal = 0
@@ -63,7 +209,7 @@ class BinaryParser:
                     if line.startswith('padding'):
                         try:
                             _, datalen = line.split(' ')
-                        except:
+                        except ValueError:
                             raise InvalidLayoutError(
                                 'padding must have one argument', lineno)
                         datalen = int(datalen)
@@ -77,9 +223,12 @@ class BinaryParser:
                         try:
                             columnname, datatype, datalen \
                                 = line.split(' ')
-                        except:
+                        except ValueError:
                             raise InvalidLayoutError(
                                 'column must have three arguments', lineno)
+                        if datatype not in ('int', 'str'):
+                            raise InvalidLayoutError(
+                                'column type must be int or str', lineno)
                         datalen = int(datalen)
                         section.append((
                             columnname,
@@ -87,7 +236,7 @@ class BinaryParser:
                             datalen
                         ))
                         subtotal += datalen
-                    line = self.layout.readline().strip()
+                    line = readline(lineno)
                     lineno += 1
                 if subtotal != int(total):
                     raise InvalidLayoutError(
@@ -96,9 +245,98 @@ class BinaryParser:
                     'offset': baseoffset,
                     'data': section
                 })
-            line = self.layout.readline().strip()
+            line = readline(lineno)
             lineno += 1
 
+        self.compile_layout()
+
+    def compile_layout(self):
+        """Adds the strides, queries and compiled sections derived from the parsed layout."""
+        for tablename, tablelayout in self.data.items():
+            for section in tablelayout['sections']:
+                section['stride'] = sum(column[2] for column in section['data'])
+                self.compile_section(section)
+
+            # The queries only depend on the layout, so build them once here
+                columns = [
+                    column
+                    for section in tablelayout['sections']
+                    for column in section['data']
+                    if column[0] != 'padding'
+                ]
+                tablelayout['create_sql'] = self.create_query(tablename, columns)
+                tablelayout['insert_sql'] = self.insert_query(
+                    tablename, [column[0] for column in columns])
+                # Integers of less than 8 bytes always fit into SQLite integer literals
+                tablelayout['inline_sql'] = None
+                if all(column[1] == 'int' and column[2] < 8 for column in columns):
+                    tablelayout['inline_sql'] = self.inline_insert_query(
+                        tablename, [column[0] for column in columns])
+
+        def compile_layout(self):
+            """Compiles all sections of a layout restored without its compiled entries."""
+            for tablelayout in self.data.values():
+                for section in tablelayout['sections']:
+                    self.compile_section(section)
+
+    def compile_section(self, section):
+        """Adds a struct for a whole row of the section and generated functions for decoding and packing its rows."""
+        byteorder = self.byteorder
+        encoding = self.encoding
+
+        # Trailing NULs can be stripped before decoding, unless the encoding uses NUL bytes inside characters (UTF-16)
+        nul_byte = '\x00'.encode(encoding) == b'\x00'
+
+        fmt = '<' if byteorder == 'little' else '>'
+        values = []  # Expression decoding each unpacked value in the generated decoder
+        encoded = []  # Expression encoding each value to pack in the generated packer
+        converted = False  # Whether any value needs decoding after unpacking
+        for name, type, length in section['data']:
+            if name == 'padding':
+                fmt += f'{length}x'
+                continue
+            value = f'v{len(values)}'
+            if type == 'int' and length in INT_FORMATS:
+                fmt += INT_FORMATS[length]
+                values.append(value)
+                encoded.append(value)
+            else:
+                # Strings and integers of unusual widths are (un)packed as raw bytes
+                fmt += f'{length}s'
+                converted = True
+                if type == 'int':
+                    values.append(f'int.from_bytes({value}, {byteorder!r})')
+                    encoded.append(f'{value}.to_bytes({length:d}, {byteorder!r})')
+                else:
+                    if nul_byte:
+                        values.append(f"{value}.rstrip(b'\\x00').decode({encoding!r})")
+                    else:
+                        values.append(f"{value}.decode({encoding!r}).rstrip('\\x00')")
+                    # The s format pads with zeroes up to the column length and truncates longer strings
+                    encoded.append(f'{value}.encode({encoding!r})')
+        section['struct_fmt'] = fmt
+        section['struct'] = struct.Struct(fmt)
+
+        # The generated functions have the byteorder, encoding and stride inlined as literals,
+        # so rows need no per-value dispatch or attribute lookups. Lengths are formatted with :d,
+        # so nothing but integers from the layout can end up in the generated source
+        names = ''.join(f'v{i}, ' for i in range(len(values))) or '_ '
+        section['decode_rows'] = None
+        if converted:
+            section['decode_rows'] = compile_function('decode_rows', (
+                'def decode_rows(rows):\n'
+                f'    for {names}in rows:\n'
+                f'        yield ({"".join(value + ", " for value in values)})\n'
+            ))
+        section['pack_rows'] = compile_function('pack_rows', (
+            'def pack_rows(buffer, offset, rows, pack_into=pack_into):\n'
+            f'    for {names}in rows:\n'
+            f'        pack_into(buffer, offset, {"".join(value + ", " for value in encoded)})\n'
+            f'        offset += {section["stride"]:d}\n'
+            '    return offset\n'
+        ), pack_into=section['struct'].pack_into)
+        return section
+
     def paramstr(self, n):
         return f"({','.join(['?']*n)})"
 
@@ -113,50 +351,123 @@ class BinaryParser:
         querystring = f"INSERT INTO `{tablename}` ({columnstring}) VALUES {self.paramstr(len(columnnames))};"
         return querystring
 
-    def parse_file(self, binary_path, db_path):
-        f = open(binary_path, 'rb')
+    def inline_insert_query(self, tablename, columnnames):
+        """Returns an INSERT query for integer rows formatted into the query with %, and the format of a single row."""
+        columnstring = ', '.join(columnnames)
+        querystring = f"INSERT INTO `{tablename}` ({columnstring}) VALUES "
+        return querystring, f"({','.join(['%d'] * len(columnnames))})"
+
+    def insert_rows(self, conn, tablelayout, rows):
+        """Inserts the rows of a table into the database."""
+        if tablelayout['inline_sql'] is not None and 0 < tablelayout['count'] <= INLINE_ROWS:
+            # Small integer tables are inserted with the values inlined in a single query,
+            # which SQLite parses faster than the sqlite3 module binds the parameters of each row
+            querystring, rowformat = tablelayout['inline_sql']
+            conn.execute(querystring + ','.join(map(rowformat.__mod__, rows)))
+        else:
+            conn.executemany(tablelayout['insert_sql'], rows)
 
+    def connect_database(self, db_path):
+        """Opens the database and tunes it for bulk loading: WAL journaling, relaxed syncing and a larger page cache."""
         conn = connect(db_path)
-
-        for tablename, tablelayout in self.data.items():
-            columns = [
-                column
-                for section in tablelayout['sections']
-                for column in section['data']
-                if column[0] != 'padding'
-            ]
-
-            query = self.create_query(tablename, columns)
-            conn.execute(query)
-
-            tablecolumnnames = list(zip(*columns))[0]
-
-            tabledata = [[] for _ in range(tablelayout['count'])]
-
-            for section in tablelayout['sections']:
-                f.seek(section['offset'] + self.file_offset)
-
-                for columndata in tabledata:
-                    for name, type, length in section['data']:
-                        if name == 'padding':
-                            # Skip
-                            f.read(length)
-                            continue
-                        bytes = f.read(length)
-                        if type == 'int':
-                            data = int.from_bytes(bytes, self.byteorder)
-                        elif type == 'str':
-                            data = bytes.decode(self.encoding)
-                        else:
-                            raise TypeError
-                        columndata.append(data)
-
-            query = self.insert_query(tablename, tablecolumnnames)
-            conn.executemany(query, tabledata)
-
-        conn.commit()
-        conn.close()
-        f.close()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-65536")
+        return conn
+
+    def iter_section(self, buffer, section):
+        """Returns an iterator over the decoded rows of a single section, given the bytes of the section."""
+        # Unpack all rows of the contiguous section in a single C loop
+        rows = section['struct'].iter_unpack(buffer)
+        if section['decode_rows'] is None:
+            return rows
+        return section['decode_rows'](rows)
+
+    def iter_rows(self, read, tablelayout):
+        """Returns an iterator over the decoded rows of a table, joining the columns of all its sections."""
+        # read(offset, size) returns the bytes of the binary file at the given offset
+        sections = []
+        for section in tablelayout['sections']:
+            offset = section['offset'] + self.file_offset
+            size = section['stride'] * tablelayout['count']
+            buffer = read(offset, size)
+            if len(buffer) != size:
+                raise ValueError(
+                    f'binary file ends before the end of a section at offset {offset}: '
+                    f'expected {size} bytes, got {len(buffer)}')
+            sections.append(self.iter_section(buffer, section))
+        rows = sections[0]
+        for section_rows in sections[1:]:
+            # Concatenates the row tuples without a Python level loop
+            rows = map(add, rows, section_rows)
+        return rows
+
+    @contextmanager
+    def open_binary(self, binary_path):
+        """Opens a binary file and yields a function read(offset, size) returning its bytes at the given offset."""
+        with open(binary_path, 'rb', buffering=BUFFER_SIZE) as f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                # Empty files and some special files cannot be mapped, read them a section at a time instead
+                mm = None
+
+            # Yielded outside the except clause, so errors while reading are not chained to the mmap failure
+            if mm is None:
+                def read(offset, size):
+                    f.seek(offset)
+                    return f.read(size)
+
+                yield read
+                return
+
+            view = memoryview(mm)
+
+            def read(offset, size):
+                return view[offset:offset + size]
+
+            try:
+                yield read
+            finally:
+                try:
+                    view.release()
+                    mm.close()
+                except BufferError:
+                    # Row iterators abandoned by an exception may still hold slices of the mapping,
+                    # it is closed when they are garbage collected
+                    pass
+
+    def parse_file(self, binary_path, db_path, workers=1):
+        """Parses the binary file into the database. With several workers, tables are decoded in parallel processes."""
+        # Closing without a commit rolls back, so a failed parse does not leave the database locked
+        with closing(self.connect_database(db_path)) as conn:
+            # A single transaction for all tables, so SQLite only syncs once at the commit
+            conn.execute("BEGIN")
+
+            if workers > 1 and len(self.data) > 1:
+                # The workers only decode, SQLite allows a single writer anyway
+                workers = min(workers, len(self.data))
+                with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(self,)) as executor:
+                    tables = iter(self.data.items())
+                    pending = deque()
+                    while True:
+                        # Only a few tables are decoded ahead, so the decoded rows of the whole file are never held at once
+                        for tablename, tablelayout in islice(tables, 2 * workers - len(pending)):
+                            pending.append((tablelayout, executor.submit(decode_table, binary_path, tablename)))
+                        if not pending:
+                            break
+                        tablelayout, future = pending.popleft()
+                        conn.execute(tablelayout['create_sql'])
+                        self.insert_rows(conn, tablelayout, future.result())
+            else:
+                with self.open_binary(binary_path) as read:
+                    for tablelayout in self.data.values():
+                        conn.execute(tablelayout['create_sql'])
+                        # Rows are decoded while SQLite consumes them, the table is never held in memory
+                        self.insert_rows(conn, tablelayout, self.iter_rows(read, tablelayout))
+
+            conn.commit()
 
     def select_query(self, tablename, section):
         columnnames = [
@@ -168,64 +479,69 @@ class BinaryParser:
         return query
 
     def write_back(self, binary_path, db_path):
-        f = open(binary_path, 'rb+')
-
-        conn = connect(db_path)
-        cur = conn.cursor()
+        # End of the last section in the binary file
+        end = max((
+            section['offset'] + self.file_offset + section['stride'] * tablelayout['count']
+            for tablelayout in self.data.values()
+            for section in tablelayout['sections']
+        ), default=0)
+        if end == 0:
+            return
+
+        fd = os.open(binary_path, os.O_RDWR)
+        try:
+            # A mapping cannot grow, so files shorter than the layout are extended first
+            if os.fstat(fd).st_size < end:
+                os.ftruncate(fd, end)
+            mm = mmap.mmap(fd, 0, access=mmap.ACCESS_WRITE)
+        finally:
+            os.close(fd)
+
+        try:
+            with closing(self.connect_database(db_path)) as conn:
+                cur = conn.cursor()
+                fetchmany = cur.fetchmany
+                file_offset = self.file_offset
+
+                for tablename, tablelayout in self.data.items():
+                    for section in tablelayout['sections']:
+                        query = self.select_query(tablename, section)
+                        cur.execute(query)
+                        pack_rows = section['pack_rows']
+                        # Find offset in binary file to write to
+                        offset = section['offset'] + file_offset
+                        # Stream the rows in chunks to keep memory bounded for large tables
+                        while True:
+                            data = fetchmany(FETCH_SIZE)
+                            if not data:
+                                break
+                            # Pack straight into the mapped file
+                            offset = pack_rows(mm, offset, data)
+            mm.flush()
+        finally:
+            mm.close()
 
+    def write_enum_classes(self, file_path):
+        # Built in memory and written to the file at once
+        buf = io.StringIO()
+        buf.write('from enum import Enum\n')
         for tablename, tablelayout in self.data.items():
+            buf.write('\n\n')
+            buf.write(f'class {tablename.capitalize()}(Enum):\n')
+            buf.write(f'\tID = 0\n')
+            i = 1
             for section in tablelayout['sections']:
-                query = self.select_query(tablename, section)
-                cur.execute(query)
-                data = cur.fetchall()
-                bytearr = bytearray()
-                for entry in data:
-                    idx = 0  # Index in the data entry without padding
-                    for name, type, length in section['data']:
-                        if name == 'padding':
-                            # Fill section with zeroes
-                            bytearr.extend([0x00 for _ in range(length)])
-                        else:
-                            data = entry[idx]
-                            if type == 'str':
-                                # Convert string of chars to bytes
-                                byteobj = bytearray(
-                                    data, encoding=self.encoding)
-                                padding_len = length - len(byteobj)
-                                byteobj += b'\x00' * padding_len
-                            elif type == 'int':
-                                # Convert n-byte integer to bytes
-                                byteobj = data.to_bytes(length, self.byteorder)
-                            else:
-                                raise TypeError
-                            # Add the section to the byte array
-                            bytearr.extend(byteobj)
-                            idx += 1
-                # Find offset in binary file to write to
-                f.seek(section['offset'] + self.file_offset)
-                f.write(bytearr)
-
-        conn.close()
-        f.close()
-
-    def write_enum_classes(self, file_path):
+                data = section['data']
+                for value in data:
+                    columnname = value[0]
+                    if columnname != 'padding':
+                        buf.write(f'\t{columnname.upper()} = {i}\n')
+                        i += 1
+            buf.write('\n')
+            buf.write("\tdef __index__(self):\n")
+            buf.write('\t\treturn self.value\n')
         with open(file_path, 'w') as f:
-            f.write('from enum import Enum\n')
-            for tablename, tablelayout in self.data.items():
-                f.write('\n\n')
-                f.write(f'class {tablename.capitalize()}(Enum):\n')
-                f.write(f'\tID = 0\n')
-                i = 1
-                for section in tablelayout['sections']:
-                    data = section['data']
-                    for value in data:
-                        columnname = value[0]
-                        if columnname != 'padding':
-                            f.write(f'\t{columnname.upper()} = {i}\n')
-                            i += 1
-                f.write('\n')
-                f.write("\tdef __index__(self):\n")
-                f.write('\t\treturn self.value\n')
+            f.write(buf.getvalue())
 
 
 def main():
@@ -245,6 +561,12 @@ def main():
         '-c',
         action='store_true',
         help='Use -c to write a python class file with enums for the given layout.')
+    parser.add_argument(
+        '-j',
+        type=int,
+        default=1,
+        metavar='WORKERS',
+        help='Number of processes decoding tables in parallel when reading a file with -r.')
     parser.add_argument(
         'layoutfile',
         help='The binary file describing the data layout of the binary file.')
@@ -258,7 +580,7 @@ def main():
 
     with BinaryParser(args.layoutfile) as bp:
         if args.r:
-            bp.parse_file(args.binaryfile, args.database)
+            bp.parse_file(args.binaryfile, args.database, args.j)
         elif args.w:
             bp.write_back(args.binaryfile, args.database)
         elif args.c:
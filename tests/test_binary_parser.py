@@ -0,0 +1,161 @@
+import json
+import os
+import sqlite3
+
+import pytest
+
+from binary_parser import BinaryParser
+
+LAYOUT = """begin
+table_1 0 10 3
+    column_1 int 2
+    column_2 str 8
+end
+
+begin
+table_2 0x1e 9 2
+    a int 4
+    padding 2
+    b int 3
+end
+
+begin
+table_2 48 14 2
+    c str 6
+    d int 8
+end
+
+endfile
+"""
+
+ROWS = {
+    'table_1': [(1, 'abc'), (65535, ''), (300, 'abcdefgh')],
+    'table_2': [(7, 70000, 'xy', 1 << 40), (4294967295, 16777215, 'vwxyz', 0)],
+}
+
+
+# Rows with strings that fill their columns in each encoding
+ENCODED_ROWS = {
+    'utf-8': ROWS,
+    'shift_jis': {
+        'table_1': [(1, '日本'), (65535, ''), (300, 'テスト')],
+        'table_2': [(7, 70000, 'テ', 1 << 40), (4294967295, 16777215, 'スト', 0)],
+    },
+    'utf-16-le': {
+        'table_1': [(1, 'abcd'), (65535, ''), (300, 'あい')],
+        'table_2': [(7, 70000, 'x', 1 << 40), (4294967295, 16777215, 'あいう', 0)],
+    },
+}
+
+
+def build_binary(byteorder='little', encoding='utf-8', rows=ROWS):
+    data = b''.join(
+        a.to_bytes(2, byteorder) + b.encode(encoding).ljust(8, b'\x00')
+        for a, b in rows['table_1'])
+    data += b''.join(
+        a.to_bytes(4, byteorder) + bytes(2) + b.to_bytes(3, byteorder)
+        for a, b, _, _ in rows['table_2'])
+    data += b''.join(
+        c.encode(encoding).ljust(6, b'\x00') + d.to_bytes(8, byteorder)
+        for _, _, c, d in rows['table_2'])
+    return data
+
+
+def read_tables(db_path):
+    conn = sqlite3.connect(db_path)
+    tables = {
+        'table_1': conn.execute('SELECT column_1, column_2 FROM table_1 ORDER BY id').fetchall(),
+        'table_2': conn.execute('SELECT a, b, c, d FROM table_2 ORDER BY id').fetchall(),
+    }
+    conn.close()
+    return tables
+
+
+@pytest.fixture
+def layout_path(tmp_path):
+    path = tmp_path / 'layout.lyt'
+    path.write_text(LAYOUT)
+    return str(path)
+
+
+def test_cache_is_reused(layout_path, monkeypatch):
+    with BinaryParser(layout_path, cache_layout=True) as bp:
+        expected = bp.uncompiled_layout()
+    assert os.path.exists(layout_path + '.cache.json')
+
+    monkeypatch.setattr(BinaryParser, 'parse_layout', lambda self: pytest.fail('layout parsed again'))
+    with BinaryParser(layout_path, cache_layout=True) as bp:
+        assert bp.uncompiled_layout() == expected
+
+
+def test_stale_cache_is_ignored(layout_path):
+    with BinaryParser(layout_path, cache_layout=True):
+        pass
+    with open(layout_path, 'w') as f:
+        f.write(LAYOUT.replace('table_1 0 10 3', 'table_1 0 10 4'))
+    stat = os.stat(layout_path)
+    os.utime(layout_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+
+    with BinaryParser(layout_path, cache_layout=True) as bp:
+        assert bp.data['table_1']['count'] == 4
+
+
+@pytest.mark.parametrize('corrupt', [
+    lambda cache: 'not json',
+    lambda cache: cache['data']['table_1']['sections'][0]['data'][0].__setitem__(2, None),
+    lambda cache: cache['data']['table_1']['sections'][0]['data'][0].__setitem__(2, '2)\n__import__("os")'),
+    lambda cache: cache['data']['table_1']['sections'][0]['data'][0].__setitem__(1, 'float'),
+    lambda cache: cache['data']['table_2']['sections'][1].__setitem__('offset', -1),
+    lambda cache: cache['data']['table_2'].pop('count'),
+])
+def test_corrupt_cache_falls_back_to_parsing(layout_path, tmp_path, corrupt):
+    with BinaryParser(layout_path, cache_layout=True) as bp:
+        expected = bp.uncompiled_layout()
+    with open(layout_path + '.cache.json') as f:
+        cache = json.load(f)
+    text = corrupt(cache)
+    with open(layout_path + '.cache.json', 'w') as f:
+        f.write(text if isinstance(text, str) else json.dumps(cache))
+
+    with BinaryParser(layout_path, cache_layout=True) as bp:
+        assert bp.uncompiled_layout() == expected
+        binary_path = tmp_path / 'data.bin'
+        binary_path.write_bytes(build_binary())
+        bp.parse_file(str(binary_path), str(tmp_path / 'data.db'))
+    assert read_tables(str(tmp_path / 'data.db')) == ROWS
+
+
+def test_cache_is_off_by_default(layout_path):
+    with BinaryParser(layout_path):
+        pass
+    assert not os.path.exists(layout_path + '.cache.json')
+
+
+def test_empty_binary_raises_unchained_error(layout_path, tmp_path):
+    binary_path = tmp_path / 'empty.bin'
+    binary_path.write_bytes(b'')
+    with BinaryParser(layout_path) as bp:
+        with pytest.raises(ValueError, match='binary file ends') as excinfo:
+            bp.parse_file(str(binary_path), str(tmp_path / 'data.db'))
+    assert excinfo.value.__context__ is None
+
+
+@pytest.mark.parametrize('byteorder', ['little', 'big'])
+@pytest.mark.parametrize('encoding', sorted(ENCODED_ROWS))
+def test_round_trip_with_and_without_workers(layout_path, tmp_path, byteorder, encoding):
+    rows = ENCODED_ROWS[encoding]
+    data = build_binary(byteorder, encoding, rows)
+    binary_path = tmp_path / 'data.bin'
+    binary_path.write_bytes(data)
+
+    with BinaryParser(layout_path, byteorder=byteorder, encoding=encoding) as bp:
+        for workers in (1, 3):
+            db_path = str(tmp_path / f'data{workers}.db')
+            bp.parse_file(str(binary_path), db_path, workers=workers)
+            assert read_tables(db_path) == rows
+
+            # Written back into an empty file, which is extended to the layout
+            new_binary_path = tmp_path / f'new{workers}.bin'
+            new_binary_path.write_bytes(b'')
+            bp.write_back(str(new_binary_path), db_path)
+            assert new_binary_path.read_bytes() == data